@@ -1,13 +1,17 @@
-import sys
+from typing import Any
+
+
+def __getattr__(name: str) -> Any:
+  # Looks up the installed version when _build_version is first accessed.
+  if name != '_build_version':
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-if sys.version_info >= (3, 8):
   from importlib.metadata import PackageNotFoundError
   from importlib.metadata import version as importlib_version
-else:
-  from importlib_metadata import PackageNotFoundError
-  from importlib_metadata import version as importlib_version
-
-try:
-  _build_version = importlib_version('changeguard')
-except PackageNotFoundError:
-  _build_version = '0.0.0'
+
+  try:
+    build_version = importlib_version('changeguard')
+  except PackageNotFoundError:
+    build_version = '0.0.0'
+  globals()['_build_version'] = build_version
+  return build_version
@@ -5,28 +5,62 @@
 # under the MIT license or a compatible open source license. See LICENSE.md for
 # the license text.
 
+import hashlib
 import json
+import os
 import shlex
 import shutil
 import subprocess
 import sys
 import textwrap
+import threading
+import time
 import traceback
 from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
                                 wait)
 from pathlib import Path
-from typing import Any, Dict, List, NamedTuple, Optional, Set, TextIO
+from typing import (TYPE_CHECKING, Any, Callable, Dict, List, Literal,
+                    NamedTuple, Optional, Protocol, Set, TextIO, Tuple)
 
-import pathspec
-import yaml
-from rich.console import Console
-from typing_extensions import Literal
+# pathspec, yaml, rich, rich_argparse and importlib.metadata are comparatively
+# slow to import, and changeguard runs many times per commit in precommit hooks,
+# so they are only imported on the code paths that need them (see also
+# changeguard/cli.py and changeguard/__init__.py).
+if TYPE_CHECKING:
+  import pathspec
 
 _VALID_METHODS = ('initial_iterdir', 'git', 'auto')
+_DEFAULT_HASH_CMD = 'xxhsum -H0'
 _MethodLiteral = Literal['initial_iterdir', 'git', 'auto']
 
+# Size of each block read for the quick fingerprint.
+_SAMPLE_BLOCK_SIZE = 4096
+# Number of evenly spaced blocks sampled between the head and tail blocks.
+_SAMPLE_STRIDED_BLOCKS = 4
 
-def _Ignore(*, rel_path: Path, ignores: List[pathspec.PathSpec]) -> bool:
+# hashlib algorithms usable for in-process hashing. The shake_* algorithms are
+# excluded because their hexdigest() requires a length.
+_VALID_HASH_ALGOS = tuple(
+    sorted(algo for algo in hashlib.algorithms_guaranteed
+           if not algo.startswith('shake_')))
+# Files at least this large are hinted to the OS to be read sequentially and
+# dropped from the page cache after hashing.
+_DEFAULT_LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+_LARGE_FILE_CHUNK_SIZE = 8 * 1024 * 1024
+# `hash --update` rehashes files modified this close to (or after) the previous
+# run's stat time, since a coarse filesystem timestamp (e.g 2s on FAT) could
+# hide a modification made just after that file was hashed.
+_RACY_MTIME_MARGIN_NS = 2 * 10**9
+
+
+class _Console(Protocol):
+  """The subset of rich.console.Console used for output."""
+
+  def print(self, *objects: Any, style: Optional[str] = None) -> None:
+    ...
+
+
+def _Ignore(*, rel_path: Path, ignores: List['pathspec.PathSpec']) -> bool:
   return any(ignore.match_file(str(rel_path)) for ignore in ignores)
 
 
@@ -56,7 +90,7 @@ class _PathList(NamedTuple):
 
 
 def _GetPathsViaIterDir(*, directory: Path,
-                        ignores: List[pathspec.PathSpec]) -> _PathList:
+                        ignores: List['pathspec.PathSpec']) -> _PathList:
   paths: List[Path] = []
   ignored: List[Path] = []
   tovisit = [directory]
@@ -77,7 +111,7 @@ def _GetPathsViaIterDir(*, directory: Path,
 
 
 def _GetPathsViaGit(*, directory: Path,
-                    ignores: List[pathspec.PathSpec]) -> _PathList:
+                    ignores: List['pathspec.PathSpec']) -> _PathList:
   cmd = ['git', 'ls-files']
   output: str = _Execute(cmd=cmd, cwd=directory)
   paths: List[Path] = []
@@ -87,9 +121,9 @@ def _GetPathsViaGit(*, directory: Path,
     if len(line) == 0:
       continue
     rel_path = Path(line)
-    if not rel_path.exists():
+    if not (directory / rel_path).exists():
       raise Exception(
-          f'git ls-files gave a file that does not exist, line={line}, path.exists(): {rel_path.exists()}'
+          f'git ls-files gave a file that does not exist, line={line}, path.exists(): {(directory / rel_path).exists()}'
       )
     if _Ignore(rel_path=rel_path, ignores=ignores):
       ignored.append(rel_path)
@@ -99,7 +133,7 @@ def _GetPathsViaGit(*, directory: Path,
 
 
 def _GetPaths(*, directory: Path, method: _MethodLiteral,
-              ignores: List[pathspec.PathSpec]) -> _PathList:
+              ignores: List['pathspec.PathSpec']) -> _PathList:
   if method == 'initial_iterdir':
     return _GetPathsViaIterDir(directory=directory, ignores=ignores)
   elif method == 'git':
@@ -127,32 +161,255 @@ def _HashPath(*, hash_cmd: str, directory: Path, path: Path) -> str:
   return hash_str.strip()
 
 
-def _HashPaths(*, hash_cmd: str, directory: Path, paths: List[Path],
-               max_workers: int) -> List[Future]:
+class _QuickFingerprint(NamedTuple):
+  size: int
+  sample: str
+
+
+def _SampleBlocks(*, size: int) -> List[Tuple[int, int]]:
+  """(offset, length) of the blocks that make up the quick fingerprint of a file.
+
+  Small files are sampled in their entirety.
+  """
+  if size <= _SAMPLE_BLOCK_SIZE * (_SAMPLE_STRIDED_BLOCKS + 2):
+    return [(0, size)]
+  offsets = {0, size - _SAMPLE_BLOCK_SIZE}
+  for i in range(1, _SAMPLE_STRIDED_BLOCKS + 1):
+    offsets.add(i * size // (_SAMPLE_STRIDED_BLOCKS + 1))
+  # Overlapping blocks are merged, so that each byte is sampled once and in file
+  # order, no matter how the file is read.
+  blocks: List[Tuple[int, int]] = []
+  for offset in sorted(offsets):
+    if blocks and offset < blocks[-1][0] + blocks[-1][1]:
+      prev_offset, _ = blocks[-1]
+      blocks[-1] = (prev_offset, offset + _SAMPLE_BLOCK_SIZE - prev_offset)
+    else:
+      blocks.append((offset, _SAMPLE_BLOCK_SIZE))
+  return blocks
+
+
+class _SampleHasher:
+  """Computes the sample of a quick fingerprint from the chunks of a sequential
+  read of the whole file, so that it describes the same contents as the full
+  digest computed from those chunks."""
+
+  def __init__(self, *, size: int):
+    self._blocks = _SampleBlocks(size=size)
+    self._hasher = hashlib.blake2b(digest_size=16)
+
+  def Update(self, *, offset: int, chunk: memoryview):
+    end = offset + len(chunk)
+    for block_offset, block_length in self._blocks:
+      start = max(offset, block_offset)
+      stop = min(end, block_offset + block_length)
+      if start < stop:
+        self._hasher.update(chunk[start - offset:stop - offset])
+
+  def HexDigest(self) -> str:
+    return self._hasher.hexdigest()
+
+
+def _QuickFingerprintPath(*, directory: Path, path: Path) -> _QuickFingerprint:
+  """Cheap fingerprint of a file: its size, and a digest of its head, tail and a
+  few strided blocks.
+
+  Not a substitute for the full hash; a match only means the file *might* be
+  unchanged.
+  """
+  with (directory / path).open('rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    hasher = hashlib.blake2b(digest_size=16)
+    for offset, length in _SampleBlocks(size=size):
+      f.seek(offset)
+      hasher.update(f.read(length))
+  return _QuickFingerprint(size=size, sample=hasher.hexdigest())
+
+
+class _HashResult(NamedTuple):
+  digest: str
+  # None if the fingerprint was not requested.
+  quick: Optional[_QuickFingerprint]
+
+
+class _HashStats:
+  """Thread-safe tally of the bytes hashed in-process, for throughput reports."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._start = time.perf_counter()
+    self.files = 0
+    self.large_files = 0
+    self.bytes = 0
+
+  def Add(self, *, size: int, large: bool):
+    with self._lock:
+      self.files += 1
+      self.large_files += int(large)
+      self.bytes += size
+
+  def Summary(self) -> str:
+    elapsed = max(time.perf_counter() - self._start, 1e-9)
+    gb = self.bytes / 1e9
+    return (f'Hashed {self.files} files ({self.large_files} large),'
+            f' {gb:.3f} GB in {elapsed:.2f}s ({gb / elapsed:.3f} GB/s)')
+
+
+_worker_local = threading.local()
+
+
+def _GetWorkerBuffer() -> bytearray:
+  """Returns a chunk buffer that is reused for every file a worker thread hashes,
+  instead of allocating a fresh bytes object per read."""
+  buffer: Optional[bytearray] = getattr(_worker_local, 'buffer', None)
+  if buffer is None:
+    buffer = bytearray(_LARGE_FILE_CHUNK_SIZE)
+    _worker_local.buffer = buffer
+  return buffer
+
+
+def _Fadvise(*, fd: int, offset: int, length: int, advice_name: str):
+  # posix_fadvise() is not available on every platform (e.g macOS, Windows), and
+  # it is only a hint anyway.
+  if not hasattr(os, 'posix_fadvise'):
+    return
+  os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+
+
+def _HashPathInProcess(*, hash_algo: str, directory: Path, path: Path,
+                       large_file_threshold: int,
+                       stats: _HashStats) -> _HashResult:
+  """Hashes the file, and computes its quick fingerprint in the same read."""
+  hasher = hashlib.new(hash_algo)
+  buffer = _GetWorkerBuffer()
+  view = memoryview(buffer)
+  with (directory / path).open('rb', buffering=0) as f:
+    fd = f.fileno()
+    size = os.fstat(fd).st_size
+    sample_hasher = _SampleHasher(size=size)
+    large = size >= large_file_threshold
+    if large:
+      _Fadvise(fd=fd, offset=0, length=0, advice_name='POSIX_FADV_SEQUENTIAL')
+    offset = 0
+    while True:
+      n = f.readinto(buffer)
+      if not n:
+        break
+      # hashlib releases the GIL while digesting large buffers, so the workers
+      # hash in parallel.
+      hasher.update(view[:n])
+      sample_hasher.Update(offset=offset, chunk=view[:n])
+      if large:
+        # Drop the pages we have already consumed, so that hashing a large file
+        # does not evict the page cache of the tools that run next.
+        _Fadvise(fd=fd,
+                 offset=offset,
+                 length=n,
+                 advice_name='POSIX_FADV_DONTNEED')
+      offset += n
+  stats.Add(size=offset, large=large)
+  return _HashResult(digest=hasher.hexdigest(),
+                     quick=_QuickFingerprint(size=size,
+                                             sample=sample_hasher.HexDigest()))
+
+
+class _RootedPath(NamedTuple):
+  """A path, relative to the root directory it was found in."""
+  directory: Path
+  path: Path
+
+
+def _SubmitPaths(*, fn: Callable[[_RootedPath], Any], paths: List[_RootedPath],
+                 max_workers: int) -> List[Future]:
   futures: Set[Future] = set()
-  path2fut: Dict[Path, Future] = {}
+  ordered_futures: List[Future] = []
   with ThreadPoolExecutor(max_workers=max_workers) as executor:
     for path in paths:
-      fut = executor.submit(_HashPath,
-                            hash_cmd=hash_cmd,
-                            directory=directory,
-                            path=path)
-      path2fut[path] = fut
+      fut = executor.submit(fn, path)
+      ordered_futures.append(fut)
       futures.add(fut)
       if len(futures) >= max_workers:
         done, futures = wait(futures, return_when=FIRST_COMPLETED)
 
-  return [path2fut[path] for path in paths]
+  return ordered_futures
+
+
+def _HashPathViaCmd(*, hash_cmd: str, directory: Path, path: Path,
+                    fingerprint: bool) -> _HashResult:
+  quick: Optional[_QuickFingerprint] = None
+  if fingerprint:
+    quick = _QuickFingerprintPath(directory=directory, path=path)
+  return _HashResult(digest=_HashPath(hash_cmd=hash_cmd,
+                                      directory=directory,
+                                      path=path),
+                     quick=quick)
+
+
+def _HashPaths(*, hash_cmd: str, hash_algo: Optional[str],
+               paths: List[_RootedPath], max_workers: int,
+               large_file_threshold: int, fingerprint: bool,
+               stats: _HashStats) -> List[Future]:
+  """Hashes the paths, each future resolves to a _HashResult.
+
+  Args:
+      fingerprint: Also compute the quick fingerprint of each path, in the same
+        worker call. In-process hashing always computes it, from the same read.
+  """
+  if hash_algo is not None:
+    algo: str = hash_algo
+    return _SubmitPaths(fn=lambda rooted: _HashPathInProcess(
+        hash_algo=algo,
+        directory=rooted.directory,
+        path=rooted.path,
+        large_file_threshold=large_file_threshold,
+        stats=stats),
+                        paths=paths,
+                        max_workers=max_workers)
+  return _SubmitPaths(
+      fn=lambda rooted: _HashPathViaCmd(hash_cmd=hash_cmd,
+                                        directory=rooted.directory,
+                                        path=rooted.path,
+                                        fingerprint=fingerprint),
+      paths=paths,
+      max_workers=max_workers)
+
+
+def _QuickFingerprintPaths(*, paths: List[_RootedPath],
+                           max_workers: int) -> List[Future]:
+  return _SubmitPaths(fn=lambda rooted: _QuickFingerprintPath(
+      directory=rooted.directory, path=rooted.path),
+                      paths=paths,
+                      max_workers=max_workers)
+
+
+class _StatSignature(NamedTuple):
+  size: int
+  mtime_ns: int
+  ctime_ns: int
+  ino: int
+
+
+def _StatSignaturePath(*, directory: Path, path: Path) -> _StatSignature:
+  st = os.stat(directory / path)
+  return _StatSignature(size=st.st_size,
+                        mtime_ns=st.st_mtime_ns,
+                        ctime_ns=st.st_ctime_ns,
+                        ino=st.st_ino)
 
 
 class _Failure(NamedTuple):
   message: Optional[str]
-  path: Optional[Path]
+  path: Optional[_RootedPath]
   exception: Optional[Exception]
 
 
-def _CheckFailures(*, failures: List[_Failure], directory: Path,
-                   tmp_backup_dir: Optional[Path], console: Console):
+def _PrintFailures(*, failures: List[_Failure],
+                   tmp_backup_dirs: Dict[Path, Path], console: _Console):
+  """Prints the failures, if there are any.
+
+  Args:
+      tmp_backup_dirs: Maps each root directory to its backup directory. A diff
+        against the backup is shown for failures in these roots.
+  """
   if len(failures) == 0:
     return
 
@@ -162,7 +419,9 @@ def _CheckFailures(*, failures: List[_Failure], directory: Path,
     if failure.message:
       console.print(textwrap.indent(failure.message, '  '), style='bold red')
     if failure.path:
-      console.print('  at:', failure.path, style='bold red')
+      console.print('  at:',
+                    failure.path.directory / failure.path.path,
+                    style='bold red')
     if failure.exception:
       console.print(
           f'  Exception ({type(failure.exception).__name__}):\n{textwrap.indent(str(failure.exception), "    ")}',
@@ -175,12 +434,13 @@ def _CheckFailures(*, failures: List[_Failure], directory: Path,
                         style='bold red')
     # console.print(Traceback.from_exception(type(failure.exception), exc_value=failure.exception, traceback=failure.exception.__traceback__))
 
-    if tmp_backup_dir is not None and failure.path is not None:
+    if failure.path is not None and failure.path.directory in tmp_backup_dirs:
       # Show delta
+      tmp_backup_dir = tmp_backup_dirs[failure.path.directory]
       diff = _Execute(cmd=[
           'git', 'diff', '--no-index', '--exit-code',
-          str(tmp_backup_dir / failure.path),
-          str(directory / failure.path)
+          str(tmp_backup_dir / failure.path.path),
+          str(failure.path.directory / failure.path.path)
       ],
                       expected_error_status=1,
                       cwd=Path.cwd())
@@ -188,8 +448,30 @@ def _CheckFailures(*, failures: List[_Failure], directory: Path,
       console.print('  diff:', style='bold red')
       console.print(diff, style='bold red')
 
+
+def _CheckFailures(*,
+                   failures: List[_Failure],
+                   tmp_backup_dirs: Dict[Path, Path],
+                   console: _Console,
+                   printed_failures: Optional[List[_Failure]] = None):
+  """Prints the failures and exits, if there are any.
+
+  Args:
+      tmp_backup_dirs: See _PrintFailures().
+      printed_failures: Failures that were already printed; they are not
+        printed again, but still count towards the exit.
+  """
+  printed_failures = printed_failures or []
+  if len(failures) + len(printed_failures) == 0:
+    return
+
+  _PrintFailures(failures=failures,
+                 tmp_backup_dirs=tmp_backup_dirs,
+                 console=console)
   console.print(f'{"-"*80}', style='bold red')
-  console.print('Failures:', len(failures), style='bold red')
+  console.print('Failures:',
+                len(failures) + len(printed_failures),
+                style='bold red')
   console.print('Exiting due to failures', style='bold red')
   sys.exit(1)
 
@@ -209,147 +491,512 @@ def _FindIgnoreFile(cwd: Path) -> Optional[Path]:
   return None
 
 
-def _ConstructIgnorePathSpecs(*, ignorefiles: List[TextIO],
+def _ReadIgnoreFiles(*, ignorefiles: List[TextIO]) -> Dict[str, List[str]]:
+  """Reads the lines of each ignore file, keyed by the file's name.
+
+  The files are read once up front, so that their patterns can be applied to
+  several root directories.
+  """
+  return {
+      ignorefile.name: ignorefile.read().splitlines()
+      for ignorefile in ignorefiles
+  }
+
+
+def _ConstructIgnorePathSpecs(*, ignorefile_lines: Dict[str, List[str]],
                               ignorelines: List[str],
                               ignore_metas: Dict[str, List[str]],
-                              cwd: Path) -> List[pathspec.PathSpec]:
+                              cwd: Path) -> List['pathspec.PathSpec']:
+  ignorefile_lines = dict(ignorefile_lines)
+  found_ignore_file_path: Optional[Path] = _FindIgnoreFile(cwd=cwd)
+  if found_ignore_file_path is not None:
+    ignorefile_lines[str(found_ignore_file_path)] = (
+        found_ignore_file_path.read_text().splitlines())
 
-  found_ignore_file: Optional[TextIO] = None
-  try:
-    found_ignore_file_path: Optional[Path] = _FindIgnoreFile(cwd=cwd)
-    if found_ignore_file_path is not None:
-      found_ignore_file = found_ignore_file_path.open('r')
-      ignorefiles.append(found_ignore_file)
-
-    ignores = []
-    ignorefile: TextIO
-    for ignorefile in ignorefiles:
-      ignorefile_contents = ignorefile.read()
-      ignorefile_lines: List[str] = ignorefile_contents.splitlines()
-      ignore_metas[ignorefile.name] = ignorefile_lines
-      ignores.append(
-          pathspec.PathSpec.from_lines('gitwildmatch', ignorefile_lines))
-    ignore_metas['~ignorelines'] = ignorelines
-    ignores.append(pathspec.PathSpec.from_lines('gitwildmatch', ignorelines))
-    return ignores
-  finally:
-    if found_ignore_file is not None:
-      found_ignore_file.close()
-
-
-def Hash(*, hash_cmd: str, directory: Path, method: _MethodLiteral,
-         audit_file: TextIO, ignores: List[pathspec.PathSpec],
-         ignore_metas: Dict[str, List[str]], max_workers: int,
-         tmp_backup_dir: Optional[Path], console: Console):
+  for name, lines in ignorefile_lines.items():
+    ignore_metas[name] = lines
+  ignore_metas['~ignorelines'] = list(ignorelines)
+
+  all_lines = list(ignorefile_lines.values()) + [ignorelines]
+  if not any(all_lines):
+    return []
+  import pathspec
+  return [
+      pathspec.PathSpec.from_lines('gitwildmatch', lines) for lines in all_lines
+  ]
+
+
+def _DumpAuditFile(*, audit_dict: Dict[str, Any], audit_file: TextIO):
+  """Writes the audit file as JSON if it is named *.json, otherwise as YAML."""
+  if getattr(audit_file, 'name', '').endswith('.json'):
+    json.dump(audit_dict, audit_file, indent=2, sort_keys=True)
+    return
+  import yaml
+  yaml.safe_dump(audit_dict, audit_file)
+
+
+def _LoadAuditFile(*, audit_file: TextIO) -> Dict[str, Any]:
+  contents = audit_file.read()
+  if contents.lstrip().startswith('{'):
+    # Written as JSON by _DumpAuditFile.
+    return json.loads(contents)
+  import yaml
+  return yaml.safe_load(contents)
+
+
+def _PreviousRootDicts(*, previous_audit: Optional[Dict[str,
+                                                        Any]], hash_cmd: str,
+                       hash_algo: Optional[str], directories: List[Path],
+                       console: _Console) -> Dict[Path, Dict[str, Any]]:
+  """The sections of the previous audit file whose digests `hash --update` can
+  reuse, keyed by root directory."""
+  if previous_audit is None:
+    return {}
+  previous_meta: Dict[str, Any] = previous_audit.get('_meta_unused', None) or {}
+  if (previous_meta.get('hash_cmd', None),
+      previous_meta.get('hash_algo', None)) != (hash_cmd, hash_algo):
+    console.print('The hash command changed since the previous audit file,'
+                  ' rehashing all files.')
+    return {}
+  if 'roots' not in previous_audit:
+    # Audit files from before multiple roots were supported describe a single
+    # root. They have no stat signatures, so nothing is reused anyway.
+    return {}
+  previous_roots: Dict[str, Any] = previous_audit['roots']
+  if len(directories) == 1 and len(previous_roots) == 1:
+    # Allow a different spelling of the path of a single root, as in audit.
+    return {directories[0]: next(iter(previous_roots.values()))}
+  return {
+      directory: previous_roots[str(directory)]
+      for directory in directories
+      if str(directory) in previous_roots
+  }
+
+
+def _CanReuseDigest(*, previous_root_dict: Dict[str, Any], path: Path,
+                    signature: _StatSignature,
+                    previous_stat_time_ns: int) -> bool:
+  previous_signature: Optional[Dict[str, Any]] = (previous_root_dict.get(
+      'stat', None) or {}).get(str(path), None)
+  if previous_signature is None:
+    return False
+  if str(path) not in previous_root_dict.get('files', {}):
+    return False
+  if str(path) not in (previous_root_dict.get('quick', None) or {}):
+    return False
+  if _StatSignature(**previous_signature) != signature:
+    return False
+  return (signature.mtime_ns + _RACY_MTIME_MARGIN_NS < previous_stat_time_ns)
+
+
+def _RootBackupDirName(*, directory: Path) -> str:
+  """The name of the subdirectory of --tmp-backup-dir that a root is backed up
+  into.
+
+  Derived from the resolved path of the root, so that it stays the same when
+  roots are added, removed or reordered.
+  """
+  resolved = directory.resolve()
+  name = ''.join(c if c.isalnum() or c in '-_.' else '_'
+                 for c in resolved.name) or 'root'
+  path_hash = hashlib.sha256(str(resolved).encode('utf-8')).hexdigest()[:16]
+  return f'{name}-{path_hash}'
+
+
+def Hash(*, hash_cmd: str, hash_algo: Optional[str], directories: List[Path],
+         method: _MethodLiteral, audit_file: TextIO, ignorefiles: List[TextIO],
+         ignorelines: List[str], max_workers: int, large_file_threshold: int,
+         tmp_backup_dir: Optional[Path],
+         previous_audit: Optional[Dict[str, Any]], console: _Console):
+  """Hashes the files of one or more root directories into one audit file.
+
+  Each root resolves its own ignore patterns, but the files of all the roots are
+  hashed by a single shared pool of workers.
+
+  Args:
+      previous_audit: For `hash --update`, the previous audit file. Files whose
+        stat signature is unchanged since then reuse their recorded digests (and
+        backups), only new or modified files are hashed.
+  """
   failures: List[_Failure] = []
 
-  paths: _PathList = _GetPaths(directory=directory,
-                               method=method,
-                               ignores=ignores)
-  hash_futures: List[Future] = _HashPaths(hash_cmd=hash_cmd,
-                                          directory=directory,
-                                          paths=paths.paths,
-                                          max_workers=max_workers)
+  if len(set(directory.resolve()
+             for directory in directories)) != len(directories):
+    console.print(
+        f'Error: Duplicate directories: {json.dumps(list(map(str, directories)))}',
+        style='bold red')
+    sys.exit(1)
+    return
+
+  ignorefile_lines = _ReadIgnoreFiles(ignorefiles=ignorefiles)
+
+  previous_root_dicts = _PreviousRootDicts(previous_audit=previous_audit,
+                                           hash_cmd=hash_cmd,
+                                           hash_algo=hash_algo,
+                                           directories=directories,
+                                           console=console)
+  previous_stat_time_ns: int = (previous_audit or {}).get('stat_time_ns', 0)
 
   audit_dict: Dict[str, Any] = {
-      'files': {},
+      'roots': {},
+      # Files are stat'd after this time, see _CanReuseDigest().
+      'stat_time_ns': time.time_ns(),
       'tmp_backup_dir':
       str(tmp_backup_dir) if tmp_backup_dir is not None else None,
       '_meta_unused': {
-          'directory': str(directory),
           'method': method,
           'hash_cmd': hash_cmd,
-          'ignored': list(map(str, paths.ignored)),
+          'hash_algo': hash_algo,
           'max_workers': max_workers,
-          'ignore_metas': ignore_metas,
       }
   }
+  root_backup_dirs: Dict[Path, Path] = {}
+  paths: List[_RootedPath] = []
+  for directory in directories:
+    ignore_metas: Dict[str, List[str]] = {}
+    ignores = _ConstructIgnorePathSpecs(ignorefile_lines=ignorefile_lines,
+                                        ignorelines=ignorelines,
+                                        ignore_metas=ignore_metas,
+                                        cwd=directory)
+    root_paths: _PathList = _GetPaths(directory=directory,
+                                      method=method,
+                                      ignores=ignores)
+    if tmp_backup_dir is not None:
+      root_backup_dirs[directory] = tmp_backup_dir / _RootBackupDirName(
+          directory=directory)
+    audit_dict['roots'][str(directory)] = {
+        'files': {},
+        'quick': {},
+        'stat': {},
+        'tmp_backup_dir':
+        str(root_backup_dirs[directory])
+        if directory in root_backup_dirs else None,
+        '_meta_unused': {
+            'ignored': list(map(str, root_paths.ignored)),
+            'ignore_metas': ignore_metas,
+        }
+    }
+    paths.extend(
+        _RootedPath(directory=directory, path=path)
+        for path in root_paths.paths)
+
+  # Record the stat signatures before hashing, so that a file modified while it
+  # is being hashed does not look unchanged to the next `hash --update`.
+  hash_paths: List[_RootedPath] = []
+  rooted: _RootedPath
+  for rooted in paths:
+    root_dict: Dict[str, Any] = audit_dict['roots'][str(rooted.directory)]
+    try:
+      signature = _StatSignaturePath(directory=rooted.directory,
+                                     path=rooted.path)
+    except Exception as e:
+      failures.append(
+          _Failure(
+              message=f'Failed to stat file: ({type(e).__name__}) {str(e)}',
+              path=rooted,
+              exception=e))
+      continue
+    root_dict['stat'][str(rooted.path)] = signature._asdict()
+    previous_root_dict = previous_root_dicts.get(rooted.directory, None)
+    if previous_root_dict is not None and _CanReuseDigest(
+        previous_root_dict=previous_root_dict,
+        path=rooted.path,
+        signature=signature,
+        previous_stat_time_ns=previous_stat_time_ns):
+      root_dict['files'][str(rooted.path)] = previous_root_dict['files'][str(
+          rooted.path)]
+      root_dict['quick'][str(rooted.path)] = previous_root_dict['quick'][str(
+          rooted.path)]
+      continue
+    hash_paths.append(rooted)
+  _CheckFailures(failures=failures, tmp_backup_dirs={}, console=console)
+  if previous_audit is not None:
+    console.print(f'Reusing {len(paths) - len(hash_paths)} unchanged files,'
+                  f' hashing {len(hash_paths)} new or modified files')
+
+  stats = _HashStats()
+  hash_futures: List[Future] = _HashPaths(
+      hash_cmd=hash_cmd,
+      hash_algo=hash_algo,
+      paths=hash_paths,
+      max_workers=max_workers,
+      large_file_threshold=large_file_threshold,
+      fingerprint=True,
+      stats=stats)
+  # _HashPaths() returns once all the files are hashed.
+  if hash_algo is not None:
+    console.print(stats.Summary())
 
-  path: Path
   hash_fut: Future
-  for path, hash_fut in zip(paths.paths, hash_futures):
+  for rooted, hash_fut in zip(hash_paths, hash_futures):
+    root_dict = audit_dict['roots'][str(rooted.directory)]
     try:
-      audit_dict['files'][str(path)] = hash_fut.result()
+      hash_result: _HashResult = hash_fut.result()
+      assert hash_result.quick is not None
+      root_dict['files'][str(rooted.path)] = hash_result.digest
+      root_dict['quick'][str(rooted.path)] = hash_result.quick._asdict()
     except Exception as e:
       failures.append(
           _Failure(
               message=f'Failed to hash file: ({type(e).__name__}) {str(e)}',
-              path=path,
+              path=rooted,
               exception=e))
-  _CheckFailures(failures=failures,
-                 directory=directory,
-                 tmp_backup_dir=None,
-                 console=console)
+  _CheckFailures(failures=failures, tmp_backup_dirs={}, console=console)
 
-  if tmp_backup_dir is not None:
-    for path in paths.paths:
-      # Copy path to tmp_backup_dir
-      dst_path = tmp_backup_dir / path
-      dst_path.parent.mkdir(parents=True, exist_ok=True)
-      shutil.copy(directory / path, dst_path)
-      dst_path.chmod(0o777)
+  # Roots whose backup dir is the same as in the previous run, which already
+  # backed up their unchanged files.
+  reused_backup_roots: Set[Path] = {
+      directory
+      for directory, previous_root_dict in previous_root_dicts.items()
+      if directory in root_backup_dirs and previous_root_dict.get(
+          'tmp_backup_dir', None) == str(root_backup_dirs[directory])
+  }
+  for directory in reused_backup_roots:
+    # Drop the backups of files that are no longer listed.
+    for path_str in previous_root_dicts[directory].get('files', {}):
+      if path_str in audit_dict['roots'][str(directory)]['files']:
+        continue
+      stale_path = root_backup_dirs[directory] / path_str
+      if stale_path.is_file():
+        stale_path.unlink()
 
-  yaml.safe_dump(audit_dict, audit_file)
+  hashed = set(hash_paths)
+  for rooted in paths:
+    if rooted.directory not in root_backup_dirs:
+      continue
+    # Copy path to the root's backup dir
+    dst_path = root_backup_dirs[rooted.directory] / rooted.path
+    if (rooted not in hashed and rooted.directory in reused_backup_roots
+        and dst_path.exists()):
+      continue
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy(rooted.directory / rooted.path, dst_path)
+    dst_path.chmod(0o777)
+
+  _DumpAuditFile(audit_dict=audit_dict, audit_file=audit_file)
   console.print('Hashing complete', style='bold green')
 
 
-def Audit(*, hash_cmd: str, directory: Path, audit_file: TextIO,
-          max_workers: int, show_delta: bool, console: Console):
+def _SelectAuditRoots(*, audit_dict: Dict[str, Any], directories: List[Path],
+                      console: _Console) -> Dict[Path, Dict[str, Any]]:
+  """Picks the sections of the audit file to audit, keyed by root directory.
+
+  With no directories, all the roots in the audit file are audited.
+  """
+  if 'roots' not in audit_dict:
+    # Audit files from before multiple roots were supported describe a single
+    # root, whose directory is not recorded.
+    if len(directories) != 1:
+      console.print(
+          'Error: This audit file has a single unnamed root, exactly one --directory is required.',
+          style='bold red')
+      sys.exit(1)
+    return {directories[0]: audit_dict}
+
+  recorded: Dict[Path, Dict[str, Any]] = {
+      Path(directory_str): root_dict
+      for directory_str, root_dict in audit_dict['roots'].items()
+  }
+  if len(directories) == 0:
+    return recorded
+  if len(directories) == 1 and len(recorded) == 1:
+    # Allow auditing a single root under a different spelling of its path.
+    return {directories[0]: next(iter(recorded.values()))}
+
+  selected: Dict[Path, Dict[str, Any]] = {}
+  for directory in directories:
+    matches = [
+        recorded_directory for recorded_directory in recorded
+        if recorded_directory == directory
+        or recorded_directory.resolve() == directory.resolve()
+    ]
+    if len(matches) == 0:
+      console.print(
+          f'Error: --directory {json.dumps(str(directory))} is not a root in the audit file,'
+          f' roots: {json.dumps(list(map(str, recorded)))}',
+          style='bold red')
+      sys.exit(1)
+    selected[directory] = recorded[matches[0]]
+  return selected
+
+
+def _ResolveAuditHasher(*, audit_dict: Dict[str, Any], hash_cmd: Optional[str],
+                        hash_algo: Optional[str],
+                        console: _Console) -> Tuple[str, Optional[str]]:
+  """Picks the hash command or algorithm to audit with, defaulting to the ones
+  recorded by `hash`.
+
+  Returns:
+      Tuple[str, Optional[str]]: The hash command, and the hashlib algorithm
+        (None to use the hash command).
+  """
+  meta: Dict[str, Any] = audit_dict.get('_meta_unused', None) or {}
+  if 'hash_algo' not in meta:
+    # Audit files from before --hash-algo existed were always hashed with a
+    # hash command, which they might not record.
+    return (hash_cmd or meta.get('hash_cmd', None)
+            or _DEFAULT_HASH_CMD, hash_algo)
+
+  recorded_algo: Optional[str] = meta['hash_algo']
+  recorded_cmd: str = meta.get('hash_cmd', None) or _DEFAULT_HASH_CMD
+  if recorded_algo is not None:
+    if hash_algo is not None and hash_algo != recorded_algo:
+      console.print(
+          f'Error: --hash-algo {hash_algo} does not match the audit file, which was hashed with --hash-algo {recorded_algo}.',
+          style='bold red')
+      sys.exit(1)
+    if hash_cmd is not None:
+      console.print(
+          f'Error: --hash-cmd conflicts with the audit file, which was hashed with --hash-algo {recorded_algo}.',
+          style='bold red')
+      sys.exit(1)
+    return (recorded_cmd, recorded_algo)
+
+  if hash_algo is not None:
+    console.print(
+        f'Error: --hash-algo conflicts with the audit file, which was hashed with --hash-cmd {json.dumps(recorded_cmd)}.',
+        style='bold red')
+    sys.exit(1)
+  return (hash_cmd or recorded_cmd, None)
+
+
+def Audit(*, hash_cmd: Optional[str], hash_algo: Optional[str],
+          directories: List[Path], audit_file: TextIO, max_workers: int,
+          large_file_threshold: int, show_delta: bool, console: _Console):
+  """Audits the roots in the audit file.
+
+  Args:
+      hash_cmd: Defaults to the hash command recorded in the audit file.
+      hash_algo: Defaults to the hashlib algorithm recorded in the audit file.
+  """
   failures: List[_Failure] = []
-  audit_dict: Dict[str, Any] = yaml.safe_load(audit_file)
+  audit_dict: Dict[str, Any] = _LoadAuditFile(audit_file=audit_file)
+  resolved_hash_cmd, resolved_hash_algo = _ResolveAuditHasher(
+      audit_dict=audit_dict,
+      hash_cmd=hash_cmd,
+      hash_algo=hash_algo,
+      console=console)
+  root_dicts = _SelectAuditRoots(audit_dict=audit_dict,
+                                 directories=directories,
+                                 console=console)
 
-  tmp_backup_dir: Optional[Path] = None
+  tmp_backup_dirs: Dict[Path, Path] = {}
   if show_delta:
-    if audit_dict.get('tmp_backup_dir', None) is None:
-      console.print('Error: show_delta is True, but tmp_backup_dir is None',
-                    style='bold red')
-      sys.exit(1)
-      return
-    tmp_backup_dir = Path(audit_dict['tmp_backup_dir'])
+    for directory, root_dict in root_dicts.items():
+      if root_dict.get('tmp_backup_dir', None) is None:
+        console.print(
+            f'Error: show_delta is True, but tmp_backup_dir is None for {json.dumps(str(directory))}',
+            style='bold red')
+        sys.exit(1)
+        return
+      tmp_backup_dirs[directory] = Path(root_dict['tmp_backup_dir'])
 
-  paths: List[Path] = []
+  paths: List[_RootedPath] = []
   expected_hashes: List[str] = []
-  for path_str, expected_hash in audit_dict['files'].items():
-    path = Path(path_str)
-    if not path.exists():
+  for directory, root_dict in root_dicts.items():
+    for path_str, expected_hash in root_dict['files'].items():
+      rooted = _RootedPath(directory=directory, path=Path(path_str))
+      if not (rooted.directory / rooted.path).exists():
+        failures.append(
+            _Failure(message='File does not exist', path=rooted,
+                     exception=None))
+        continue
+      paths.append(rooted)
+      expected_hashes.append(expected_hash)
+
+  # Quick tier: compare sizes and sampled fingerprints first, so that most
+  # changes are reported without waiting for the full hashes. Audit files from
+  # older versions have no 'quick' section, and go straight to full hashing.
+  # Files that fail here are not fully hashed, the rest still are.
+  def _ExpectedQuicks(rooted: _RootedPath) -> Dict[str, Any]:
+    return root_dicts[rooted.directory].get('quick', None) or {}
+
+  quick_paths: List[_RootedPath] = [
+      rooted for rooted in paths if str(rooted.path) in _ExpectedQuicks(rooted)
+  ]
+  quick_futures: List[Future] = _QuickFingerprintPaths(paths=quick_paths,
+                                                       max_workers=max_workers)
+  quick_fut: Future
+  for rooted, quick_fut in zip(quick_paths, quick_futures):
+    expected_quick = _QuickFingerprint(
+        **_ExpectedQuicks(rooted)[str(rooted.path)])
+    try:
+      actual_quick: _QuickFingerprint = quick_fut.result()
+      if expected_quick.size != actual_quick.size:
+        failures.append(
+            _Failure(
+                message=
+                f'Size mismatch: expected_size={expected_quick.size} actual={actual_quick.size}',
+                path=rooted,
+                exception=None))
+      elif expected_quick.sample != actual_quick.sample:
+        failures.append(
+            _Failure(
+                message=
+                f'Sampled fingerprint mismatch: expected_sample={json.dumps(expected_quick.sample)} actual={json.dumps(actual_quick.sample)}',
+                path=rooted,
+                exception=None))
+    except Exception as e:
       failures.append(
-          _Failure(message='File does not exist', path=path, exception=None))
-      continue
-    paths.append(path)
-    expected_hashes.append(expected_hash)
-
-  checked_hash_futures: List[Future] = _HashPaths(hash_cmd=hash_cmd,
-                                                  directory=directory,
-                                                  paths=paths,
-                                                  max_workers=max_workers)
-  for path, expected_hash, hash_fut in zip(paths, expected_hashes,
-                                           checked_hash_futures):
+          _Failure(message=
+                   f'Failed to fingerprint file: ({type(e).__name__}) {str(e)}',
+                   path=rooted,
+                   exception=e))
+  _PrintFailures(failures=failures,
+                 tmp_backup_dirs=tmp_backup_dirs,
+                 console=console)
+  quick_failed: Set[_RootedPath] = {
+      failure.path
+      for failure in failures
+      if failure.path is not None
+  }
+  printed_failures = failures
+  failures = []
+
+  expected_hashes = [
+      expected_hash for rooted, expected_hash in zip(paths, expected_hashes)
+      if rooted not in quick_failed
+  ]
+  paths = [rooted for rooted in paths if rooted not in quick_failed]
+  stats = _HashStats()
+  checked_hash_futures: List[Future] = _HashPaths(
+      hash_cmd=resolved_hash_cmd,
+      hash_algo=resolved_hash_algo,
+      paths=paths,
+      max_workers=max_workers,
+      large_file_threshold=large_file_threshold,
+      fingerprint=False,
+      stats=stats)
+  for rooted, expected_hash, hash_fut in zip(paths, expected_hashes,
+                                             checked_hash_futures):
     try:
-      actual_hash = hash_fut.result()
+      actual_hash = hash_fut.result().digest
       if expected_hash != actual_hash:
         failures.append(
             _Failure(
                 message=
                 f'Hash mismatch: expected_hash={json.dumps(expected_hash)} actual={json.dumps(actual_hash)}',
-                path=path,
+                path=rooted,
                 exception=None))
     except Exception as e:
       failures.append(
           _Failure(
               message=f'Failed to hash file: ({type(e).__name__}) {str(e)}',
-              path=path,
+              path=rooted,
               exception=e))
 
+  if resolved_hash_algo is not None:
+    console.print(stats.Summary())
   _CheckFailures(failures=failures,
-                 directory=directory,
-                 tmp_backup_dir=tmp_backup_dir,
-                 console=console)
+                 tmp_backup_dirs=tmp_backup_dirs,
+                 console=console,
+                 printed_failures=printed_failures)
   console.print('Audit passed', style='bold green')
   sys.exit(0)
 
 
 def TestListPaths(*, directory: Path, ignorefiles: List[TextIO],
-                  ignorelines: List[str], console: Console):
+                  ignorelines: List[str], console: _Console):
 
   git_dir = directory / '.git'
   if not git_dir.exists():
@@ -359,10 +1006,11 @@ def TestListPaths(*, directory: Path, ignorefiles: List[TextIO],
     sys.exit(1)
     return
 
-  ignores = _ConstructIgnorePathSpecs(ignorefiles=ignorefiles,
-                                      ignorelines=ignorelines,
-                                      ignore_metas={},
-                                      cwd=directory)
+  ignores = _ConstructIgnorePathSpecs(
+      ignorefile_lines=_ReadIgnoreFiles(ignorefiles=ignorefiles),
+      ignorelines=ignorelines,
+      ignore_metas={},
+      cwd=directory)
   initial_iterdir_paths = _GetPathsViaIterDir(directory=directory,
                                               ignores=ignores)
   git_paths = _GetPathsViaGit(directory=directory, ignores=ignores)
@@ -375,6 +1023,7 @@ def TestListPaths(*, directory: Path, ignorefiles: List[TextIO],
         map(str, initial_iterdir_paths.paths))
     dump_dict['git_paths'] = sorted(map(str, git_paths.paths))
     dump_dict['delta'] = sorted(map(str, (delta)))
+    import yaml
     console.print(yaml.safe_dump(dump_dict))
     console.print('Error: initial_iterdir_paths and git_paths do not match.',
                   style='bold red')
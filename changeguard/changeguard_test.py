@@ -5,12 +5,23 @@
 # under the MIT license or a compatible open source license. See LICENSE.md for
 # the license text.
 
+import hashlib
+import io
+import os
 import shutil
 import tempfile
+import time
 import unittest
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
-from .changeguard import _FindIgnoreFile
+import yaml
+from rich.console import Console
+
+from .changeguard import (_LARGE_FILE_CHUNK_SIZE, _SAMPLE_BLOCK_SIZE, Audit,
+                          Hash, _FindIgnoreFile, _HashPathInProcess,
+                          _HashStats, _QuickFingerprintPath,
+                          _RootBackupDirName, _SampleHasher)
 
 
 class TestFindIgnoreFile(unittest.TestCase):
@@ -51,5 +62,322 @@ class TestFindIgnoreFile(unittest.TestCase):
     self.assertIsNone(result)
 
 
+class TestQuickFingerprint(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.directory = Path(self.test_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Write(self, rel_path: str, data: bytes) -> Path:
+    (self.directory / rel_path).write_bytes(data)
+    return Path(rel_path)
+
+  def test_same_contents_match(self):
+    a = self._Write('a', b'hello world')
+    b = self._Write('b', b'hello world')
+    self.assertEqual(_QuickFingerprintPath(directory=self.directory, path=a),
+                     _QuickFingerprintPath(directory=self.directory, path=b))
+
+  def test_small_file_change_detected(self):
+    path = self._Write('a', b'hello world')
+    before = _QuickFingerprintPath(directory=self.directory, path=path)
+    self._Write('a', b'hello World')
+    after = _QuickFingerprintPath(directory=self.directory, path=path)
+    self.assertEqual(before.size, after.size)
+    self.assertNotEqual(before.sample, after.sample)
+
+  def test_large_file_tail_change_detected(self):
+    data = bytearray(_SAMPLE_BLOCK_SIZE * 100)
+    path = self._Write('a', bytes(data))
+    before = _QuickFingerprintPath(directory=self.directory, path=path)
+    data[-1] = 1
+    self._Write('a', bytes(data))
+    after = _QuickFingerprintPath(directory=self.directory, path=path)
+    self.assertEqual(before.size, len(data))
+    self.assertNotEqual(before.sample, after.sample)
+
+  def test_sample_hasher_matches_chunked_read(self):
+    # 30000 and 40000 have strided blocks that overlap the tail block.
+    for size in (_SAMPLE_BLOCK_SIZE * 30, 30000, 40000):
+      # Chunks that do not line up with the sampled blocks.
+      for chunk_size in (_SAMPLE_BLOCK_SIZE // 3 + 1, 1000):
+        with self.subTest(size=size, chunk_size=chunk_size):
+          data = (bytes(range(256)) * (size // 256 + 1))[:size]
+          path = self._Write('a', data)
+          sample_hasher = _SampleHasher(size=len(data))
+          for offset in range(0, len(data), chunk_size):
+            sample_hasher.Update(offset=offset,
+                                 chunk=memoryview(data[offset:offset +
+                                                       chunk_size]))
+          self.assertEqual(
+              sample_hasher.HexDigest(),
+              _QuickFingerprintPath(directory=self.directory, path=path).sample)
+
+  def test_size_change_detected(self):
+    path = self._Write('a', b'hello')
+    before = _QuickFingerprintPath(directory=self.directory, path=path)
+    self._Write('a', b'hello!')
+    after = _QuickFingerprintPath(directory=self.directory, path=path)
+    self.assertNotEqual(before.size, after.size)
+
+
+class TestHashPathInProcess(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.directory = Path(self.test_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_small_and_large_paths_agree(self):
+    # Spans several chunks, with a partial chunk at the end.
+    data = bytes(range(256)) * (_LARGE_FILE_CHUNK_SIZE * 2 // 256 + 3)
+    (self.directory / 'a').write_bytes(data)
+    expected = hashlib.sha256(data).hexdigest()
+    for large_file_threshold in (0, len(data) + 1):
+      stats = _HashStats()
+      actual = _HashPathInProcess(hash_algo='sha256',
+                                  directory=self.directory,
+                                  path=Path('a'),
+                                  large_file_threshold=large_file_threshold,
+                                  stats=stats)
+      self.assertEqual(actual.digest, expected)
+      self.assertEqual(
+          actual.quick,
+          _QuickFingerprintPath(directory=self.directory, path=Path('a')))
+      self.assertEqual(stats.bytes, len(data))
+      self.assertEqual(stats.large_files, int(large_file_threshold == 0))
+
+  def test_empty_file(self):
+    (self.directory / 'a').write_bytes(b'')
+    actual = _HashPathInProcess(hash_algo='sha256',
+                                directory=self.directory,
+                                path=Path('a'),
+                                large_file_threshold=0,
+                                stats=_HashStats())
+    self.assertEqual(actual.digest, hashlib.sha256(b'').hexdigest())
+
+
+class _HashAuditTestCase(unittest.TestCase):
+  """Two roots, hashed with Hash() and audited with Audit()."""
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.root_a = Path(self.test_dir) / 'a'
+    self.root_b = Path(self.test_dir) / 'b'
+    (self.root_a / 'sub').mkdir(parents=True)
+    self.root_b.mkdir()
+    (self.root_a / 'sub' / 'f').write_text('one')
+    (self.root_b / 'g').write_text('two')
+    (self.root_b / 'skipped').write_text('three')
+    (self.root_b / '.changeguard-ignore').write_text('skipped\n')
+    self.console_output = io.StringIO()
+    self.console = Console(file=self.console_output, width=1000)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Hash(self,
+            previous_audit: Optional[Dict[str, Any]] = None,
+            *,
+            hash_cmd: str = '',
+            hash_algo: Optional[str] = 'sha256',
+            tmp_backup_dir: Optional[Path] = None,
+            directories: Optional[List[Path]] = None) -> str:
+    audit_file = io.StringIO()
+    Hash(hash_cmd=hash_cmd,
+         hash_algo=hash_algo,
+         directories=directories or [self.root_a, self.root_b],
+         method='initial_iterdir',
+         audit_file=audit_file,
+         ignorefiles=[],
+         ignorelines=[],
+         max_workers=2,
+         large_file_threshold=1024,
+         tmp_backup_dir=tmp_backup_dir,
+         previous_audit=previous_audit,
+         console=self.console)
+    return audit_file.getvalue()
+
+  def _Audit(self,
+             audit_yaml: str,
+             *,
+             hash_cmd: Optional[str] = None,
+             hash_algo: Optional[str] = None,
+             directories: Optional[List[Path]] = None) -> int:
+    with self.assertRaises(SystemExit) as cm:
+      Audit(hash_cmd=hash_cmd,
+            hash_algo=hash_algo,
+            directories=directories or [],
+            audit_file=io.StringIO(audit_yaml),
+            max_workers=2,
+            large_file_threshold=1024,
+            show_delta=False,
+            console=self.console)
+    return int(cm.exception.code or 0)
+
+
+class TestMultiRoot(_HashAuditTestCase):
+
+  def test_roots_have_own_ignores(self):
+    audit_dict = yaml.safe_load(self._Hash())
+    roots = audit_dict['roots']
+    self.assertEqual(sorted(roots[str(self.root_a)]['files']), ['sub/f'])
+    self.assertEqual(sorted(roots[str(self.root_b)]['files']),
+                     ['.changeguard-ignore', 'g'])
+
+  def test_audit_checks_all_roots(self):
+    audit_yaml = self._Hash()
+    self.assertEqual(self._Audit(audit_yaml), 0)
+    (self.root_b / 'skipped').write_text('changed')
+    self.assertEqual(self._Audit(audit_yaml), 0)
+    (self.root_b / 'g').write_text('changed')
+    self.assertEqual(self._Audit(audit_yaml), 1)
+
+  def test_duplicate_roots_rejected(self):
+    relative_root_a = Path(os.path.relpath(self.root_a))
+    with self.assertRaises(SystemExit) as cm:
+      Hash(hash_cmd='',
+           hash_algo='sha256',
+           directories=[self.root_a, relative_root_a],
+           method='initial_iterdir',
+           audit_file=io.StringIO(),
+           ignorefiles=[],
+           ignorelines=[],
+           max_workers=2,
+           large_file_threshold=1024,
+           tmp_backup_dir=None,
+           previous_audit=None,
+           console=self.console)
+    self.assertEqual(cm.exception.code, 1)
+    self.assertIn('Duplicate directories', self.console_output.getvalue())
+
+  def test_audit_subset_of_roots(self):
+    audit_yaml = self._Hash()
+    (self.root_b / 'g').write_text('changed')
+    self.assertEqual(self._Audit(audit_yaml, directories=[self.root_a]), 0)
+    self.assertEqual(self._Audit(audit_yaml, directories=[self.root_b]), 1)
+
+  def test_audit_unknown_root(self):
+    audit_yaml = self._Hash()
+    self.assertEqual(
+        self._Audit(audit_yaml,
+                    directories=[self.root_a,
+                                 Path(self.test_dir) / 'c']), 1)
+    self.assertIn('is not a root in the audit file',
+                  self.console_output.getvalue())
+
+  def test_legacy_audit_file(self):
+    # Audit files from before multiple roots were supported.
+    legacy_yaml = yaml.safe_dump({
+        'files': {
+            'sub/f': hashlib.sha256(b'one').hexdigest()
+        },
+        'tmp_backup_dir': None,
+    })
+    self.assertEqual(
+        self._Audit(legacy_yaml, hash_algo='sha256', directories=[self.root_a]),
+        0)
+    self.assertEqual(self._Audit(legacy_yaml, hash_algo='sha256'), 1)
+    self.assertIn('exactly one --directory is required',
+                  self.console_output.getvalue())
+
+  def test_update_reuses_unchanged_digests(self):
+    # Old enough that the update does not consider them racily modified.
+    past = time.time() - 60
+    for path in (self.root_a / 'sub' / 'f', self.root_b / 'g'):
+      os.utime(path, (past, past))
+    previous_audit = yaml.safe_load(self._Hash())
+    # Tamper with the digest of an unchanged file, which is only kept if the
+    # file is not rehashed.
+    previous_audit['roots'][str(self.root_a)]['files']['sub/f'] = 'reused'
+
+    (self.root_b / 'g').write_text('changed')
+    (self.root_b / 'new').write_text('new')
+    (self.root_b / '.changeguard-ignore').unlink()
+
+    roots = yaml.safe_load(self._Hash(previous_audit=previous_audit))['roots']
+    self.assertEqual(roots[str(self.root_a)]['files'], {'sub/f': 'reused'})
+    root_b_files = roots[str(self.root_b)]['files']
+    self.assertEqual(sorted(root_b_files), ['g', 'new', 'skipped'])
+    self.assertEqual(root_b_files['g'], hashlib.sha256(b'changed').hexdigest())
+
+  def test_update_refreshes_only_changed_backups(self):
+    (self.root_a / 'gone').write_text('gone')
+    past = time.time() - 60
+    for path in (self.root_a / 'sub' / 'f', self.root_b / 'g'):
+      os.utime(path, (past, past))
+    backup_dir = Path(self.test_dir) / 'backup'
+    previous_audit = yaml.safe_load(self._Hash(tmp_backup_dir=backup_dir))
+    backup_a = backup_dir / _RootBackupDirName(directory=self.root_a)
+    backup_b = backup_dir / _RootBackupDirName(directory=self.root_b)
+    self.assertEqual((backup_b / 'g').read_text(), 'two')
+    # Only kept if the unchanged file is not copied again.
+    (backup_a / 'sub' / 'f').write_text('not copied again')
+
+    (self.root_b / 'g').write_text('changed')
+    (self.root_a / 'gone').unlink()
+    self._Hash(previous_audit=previous_audit, tmp_backup_dir=backup_dir)
+
+    self.assertEqual((backup_a / 'sub' / 'f').read_text(), 'not copied again')
+    self.assertEqual((backup_b / 'g').read_text(), 'changed')
+    self.assertFalse((backup_a / 'gone').exists())
+
+  def test_backup_dirs_stable_across_roots(self):
+    backup_dir = Path(self.test_dir) / 'backup'
+    audit_dict = yaml.safe_load(self._Hash(tmp_backup_dir=backup_dir))
+    backup_a = audit_dict['roots'][str(self.root_a)]['tmp_backup_dir']
+    self.assertEqual(Path(backup_a).parent, backup_dir)
+    self.assertNotEqual(backup_a,
+                        audit_dict['roots'][str(self.root_b)]['tmp_backup_dir'])
+
+    # Reordering and removing roots keeps the backup dir of the rest.
+    for directories in ([self.root_b, self.root_a], [self.root_a]):
+      with self.subTest(directories=directories):
+        audit_dict = yaml.safe_load(
+            self._Hash(tmp_backup_dir=backup_dir, directories=directories))
+        self.assertEqual(
+            audit_dict['roots'][str(self.root_a)]['tmp_backup_dir'], backup_a)
+
+
+class TestAuditQuickTier(_HashAuditTestCase):
+
+  def test_quick_failures_reported_with_full_hash_failures(self):
+    audit_yaml = self._Hash(hash_cmd='sha256sum', hash_algo=None)
+    (self.root_b / 'g').write_text('changed')
+    # The full hash always fails, so only the quick tier can report the size
+    # mismatch; the other two files still get fully hashed.
+    self.assertEqual(self._Audit(audit_yaml, hash_cmd="sh -c 'exit 3'"), 1)
+    output = self.console_output.getvalue()
+    self.assertIn('Size mismatch', output)
+    self.assertEqual(output.count('Failed to hash file'), 2)
+    self.assertLess(output.index('Size mismatch'),
+                    output.index('Failed to hash file'))
+    self.assertEqual(output.count('Exiting due to failures'), 1)
+    self.assertIn('Failures: 3\nExiting due to failures', output)
+
+
+class TestAuditHasher(_HashAuditTestCase):
+
+  def test_defaults_to_recorded_hash_algo(self):
+    self.assertEqual(self._Audit(self._Hash()), 0)
+
+  def test_same_hash_algo(self):
+    self.assertEqual(self._Audit(self._Hash(), hash_algo='sha256'), 0)
+
+  def test_conflicting_hash_algo(self):
+    self.assertEqual(self._Audit(self._Hash(), hash_algo='md5'), 1)
+    self.assertIn('does not match the audit file',
+                  self.console_output.getvalue())
+
+  def test_conflicting_hash_cmd(self):
+    self.assertEqual(self._Audit(self._Hash(), hash_cmd='sha256sum'), 1)
+    self.assertIn('--hash-cmd conflicts', self.console_output.getvalue())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -14,22 +14,19 @@
 # ```
 
 import argparse
+import contextlib
+import functools
 import json
+import os
 import sys
 import warnings
 from pathlib import Path
 from shutil import get_terminal_size
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Type
 
-from rich.console import Console
-from rich_argparse import RichHelpFormatter
-from typing_extensions import Dict
-
-from . import _build_version
-from .changeguard import (_VALID_METHODS, Audit, Hash, TestListPaths,
-                          _ConstructIgnorePathSpecs)
-
-_DEFAULT_HASH_CMD = 'xxhsum -H0'
+from .changeguard import (_DEFAULT_HASH_CMD, _DEFAULT_LARGE_FILE_THRESHOLD,
+                          _VALID_HASH_ALGOS, _VALID_METHODS, Audit, Hash,
+                          TestListPaths, _LoadAuditFile)
 
 
 def _AddIgnoreArgs(parser: argparse.ArgumentParser):
@@ -57,6 +54,70 @@ def _AddDirectoryArgs(parser: argparse.ArgumentParser, *, action: str):
                       help=f'Directory to {action}.')
 
 
+def _AddRootDirectoryArgs(parser: argparse.ArgumentParser, *, action: str,
+                          default_help: str):
+  parser.add_argument(
+      '--directory',
+      type=Path,
+      action='append',
+      default=[],
+      help=f'Directory to {action}. Can be used more than once, in which case'
+      ' each directory is a separate root with its own .changeguard-ignore,'
+      f' sharing one pool of workers and one audit file. {default_help}')
+  parser.add_argument(
+      '--directory-manifest',
+      type=argparse.FileType('r'),
+      default=None,
+      help='File listing additional directories, one per line. Blank lines and'
+      ' lines starting with "#" are skipped. Relative directories are relative'
+      ' to the manifest file.')
+
+
+@contextlib.contextmanager
+def _OpenForReplace(path: Path) -> Iterator[TextIO]:
+  """Opens a temporary file next to `path`, that replaces `path` only if the
+  block completes. A failed run thus keeps the previous file intact.
+
+  Paths that are not regular files (e.g /dev/stdout) are opened directly, and
+  symlinks have their target replaced, keeping the link.
+  """
+  if str(path) == '-':
+    yield sys.stdout
+    return
+  if path.exists() and not path.is_file():
+    with path.open('w') as f:
+      yield f
+    return
+  path = path.resolve()
+  # Keep the suffix, it determines the audit file format.
+  tmp_path = path.with_suffix('.tmp' + path.suffix)
+  try:
+    with tmp_path.open('w') as f:
+      yield f
+    os.replace(tmp_path, path)
+  finally:
+    if tmp_path.exists():
+      tmp_path.unlink()
+
+
+def _ReadDirectoryManifest(manifest: TextIO) -> List[Path]:
+  manifest_dir = Path(manifest.name).parent
+  directories: List[Path] = []
+  for line in manifest.read().splitlines():
+    line = line.strip()
+    if len(line) == 0 or line.startswith('#'):
+      continue
+    directories.append(manifest_dir / line)
+  return directories
+
+
+def _GetRootDirectories(args: argparse.Namespace) -> List[Path]:
+  directories: List[Path] = list(args.directory)
+  if args.directory_manifest is not None:
+    directories += _ReadDirectoryManifest(args.directory_manifest)
+  return directories
+
+
 def _AddHashingArgs(parser: argparse.ArgumentParser):
   parser.add_argument(
       '--max-workers',
@@ -66,36 +127,120 @@ def _AddHashingArgs(parser: argparse.ArgumentParser):
   parser.add_argument(
       '--hash-cmd',
       type=str,
-      default=_DEFAULT_HASH_CMD,
+      default=None,
       help=
-      f'Command to hash files with. Default is {json.dumps(_DEFAULT_HASH_CMD)}')
-
-
-class _CustomRichHelpFormatter(RichHelpFormatter):
-
-  def __init__(self, *args, **kwargs):
-    if kwargs.get('width') is None:
-      width, _ = get_terminal_size()
-      if width == 0:
-        warnings.warn('Terminal width was set to 0, using default width of 80.',
-                      RuntimeWarning,
-                      stacklevel=0)
-        # This is the default in get_terminal_size().
-        width = 80
-      # This is what HelpFormatter does to the width returned by
-      # `get_terminal_size()`.
-      width -= 2
-      kwargs['width'] = width
+      f'Command to hash files with. Default is {json.dumps(_DEFAULT_HASH_CMD)}'
+      ' for hash, and the one recorded in the audit file for audit.')
+  parser.add_argument(
+      '--hash-algo',
+      choices=_VALID_HASH_ALGOS,
+      default=None,
+      help='Hash files in-process with this hashlib algorithm, instead of'
+      ' running --hash-cmd once per file. Default is to use --hash-cmd for'
+      ' hash, and the one recorded in the audit file for audit.')
+  parser.add_argument(
+      '--large-file-threshold',
+      type=int,
+      default=_DEFAULT_LARGE_FILE_THRESHOLD,
+      help='Size in bytes at or above which --hash-algo hints the OS to read a'
+      ' file sequentially and not keep it in the page cache. Default is'
+      f' {_DEFAULT_LARGE_FILE_THRESHOLD}.')
+
+
+@functools.lru_cache(maxsize=None)
+def _GetRichHelpFormatter() -> Type[argparse.HelpFormatter]:
+  from rich_argparse import RichHelpFormatter
+
+  class _CustomRichHelpFormatter(RichHelpFormatter):
+
+    def __init__(self, *args, **kwargs):
+      if kwargs.get('width') is None:
+        width, _ = get_terminal_size()
+        if width == 0:
+          warnings.warn(
+              'Terminal width was set to 0, using default width of 80.',
+              RuntimeWarning,
+              stacklevel=0)
+          # This is the default in get_terminal_size().
+          width = 80
+        # This is what HelpFormatter does to the width returned by
+        # `get_terminal_size()`.
+        width -= 2
+        kwargs['width'] = width
+      super().__init__(*args, **kwargs)
+
+  return _CustomRichHelpFormatter
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+  """ArgumentParser that only imports rich_argparse to render help or usage.
+
+  argparse builds a formatter for every add_argument() call, so setting
+  formatter_class up front would import rich_argparse on every run.
+  """
+
+  def __init__(self, *args, rich_help: bool = False, **kwargs):
     super().__init__(*args, **kwargs)
+    self._rich_help = rich_help
+
+  @property
+  def version(self) -> str:
+    # Used by the 'version' action.
+    from . import _build_version
+    return _build_version
+
+  @contextlib.contextmanager
+  def _RichHelpFormatter(self) -> Iterator[None]:
+    if not self._rich_help:
+      yield
+      return
+    formatter_class = self.formatter_class
+    self.formatter_class = _GetRichHelpFormatter()
+    try:
+      yield
+    finally:
+      self.formatter_class = formatter_class
+
+  def format_usage(self) -> str:
+    with self._RichHelpFormatter():
+      return super().format_usage()
+
+  def format_help(self) -> str:
+    with self._RichHelpFormatter():
+      return super().format_help()
+
+
+class _LazyConsole:
+  """Prints plain text, and only imports rich to render errors."""
+
+  _ERROR_STYLES = ('bold red', )
+
+  def __init__(self, *, file: TextIO):
+    self._file = file
+    self._console: Optional[Any] = None
+
+  def _GetRichConsole(self) -> Any:
+    if self._console is None:
+      from rich.console import Console
+      self._console = Console(file=self._file)
+    return self._console
+
+  def print(self, *objects: Any, style: Optional[str] = None) -> None:
+    if style in self._ERROR_STYLES:
+      self._GetRichConsole().print(*objects, style=style)
+      return
+    print(*objects, file=self._file)
+
+  def print_exception(self) -> None:
+    self._GetRichConsole().print_exception()
 
 
 def main():
-  console = Console(file=sys.stderr)
+  console = _LazyConsole(file=sys.stderr)
   try:
-    parser = argparse.ArgumentParser(description=__doc__,
-                                     formatter_class=_CustomRichHelpFormatter)
+    parser = _ArgumentParser(description=__doc__, rich_help=True)
 
-    parser.add_argument('--version', action='version', version=_build_version)
+    parser.add_argument('--version', action='version')
 
     cmd = parser.add_subparsers(required=True, dest='cmd')
     hash_cmd_parser = cmd.add_parser('hash', help='Hash files in a directory.')
@@ -104,7 +249,9 @@ def main():
                                  required=True,
                                  help='Method to use to list files.')
     _AddIgnoreArgs(hash_cmd_parser)
-    _AddDirectoryArgs(hash_cmd_parser, action='hash')
+    _AddRootDirectoryArgs(hash_cmd_parser,
+                          action='hash',
+                          default_help='At least one directory is required.')
     _AddHashingArgs(hash_cmd_parser)
     hash_cmd_parser.add_argument(
         '--tmp-backup-dir',
@@ -113,18 +260,38 @@ def main():
         default=None,
         help=
         'Directory to backup files to before hashing. Useful for auditing, to show deltas.'
-    )
+        ' Each --directory is backed up into its own subdirectory, named after'
+        ' its path.')
     hash_cmd_parser.add_argument(
         '--audit-file',
-        type=argparse.FileType('w'),
+        type=Path,
         required=True,
-        help='File to output the hashes to, used for auditing.')
+        help='File to output the hashes to, used for auditing.'
+        ' Written as JSON if it ends in .json, otherwise as YAML.'
+        ' Only replaced if hashing succeeds.')
+    hash_cmd_parser.add_argument(
+        '--update',
+        action='store_true',
+        help='Update the audit file given by --from instead of hashing'
+        ' everything: files whose size, mtime, ctime and inode are unchanged'
+        ' reuse their recorded hashes (and backups in --tmp-backup-dir), only'
+        ' new or modified files are hashed, and deleted files are dropped.')
+    hash_cmd_parser.add_argument(
+        '--from',
+        dest='from_audit_file',
+        type=argparse.FileType('r'),
+        default=None,
+        help='Previous audit file to update, required by --update. Can be the'
+        ' same file as --audit-file.')
     audit_cmd_parser = cmd.add_parser(
         'audit',
         help=
         'Audit files in a directory using an existing audit file produced by `hash` command.'
     )
-    _AddDirectoryArgs(audit_cmd_parser, action='audit')
+    _AddRootDirectoryArgs(
+        audit_cmd_parser,
+        action='audit',
+        default_help='Default is to audit all the roots in the audit file.')
     audit_cmd_parser.add_argument(
         '--audit-file',
         type=argparse.FileType('r'),
@@ -148,26 +315,45 @@ def main():
     args = parser.parse_args()
 
     if args.cmd == 'hash':
-      ignore_metas: Dict[str, List[str]] = {}
-      ignores = _ConstructIgnorePathSpecs(ignorefiles=list(args.ignorefile),
-                                          ignorelines=list(args.ignoreline),
-                                          ignore_metas=ignore_metas,
-                                          cwd=args.directory)
-      return Hash(hash_cmd=args.hash_cmd,
-                  directory=args.directory,
-                  method=args.method,
-                  audit_file=args.audit_file,
-                  ignores=ignores,
-                  ignore_metas=ignore_metas,
-                  max_workers=args.max_workers,
-                  tmp_backup_dir=args.tmp_backup_dir,
-                  console=console)
+      directories = _GetRootDirectories(args)
+      if len(directories) == 0:
+        hash_cmd_parser.error(
+            'at least one of --directory or --directory-manifest is required')
+      if args.update != (args.from_audit_file is not None):
+        hash_cmd_parser.error('--update and --from must be used together')
+      # The audit file is only written after hashing, so check that it can be
+      # written before that.
+      audit_file_dir: Path = args.audit_file.parent
+      if str(args.audit_file) != '-' and not (
+          audit_file_dir.is_dir() and os.access(audit_file_dir, os.W_OK)):
+        hash_cmd_parser.error(
+            f'--audit-file directory {json.dumps(str(audit_file_dir))} does not'
+            ' exist or is not writable')
+      previous_audit: Optional[Dict[str, Any]] = None
+      if args.from_audit_file is not None:
+        # Read before the audit file is written, they may be the same file.
+        previous_audit = _LoadAuditFile(audit_file=args.from_audit_file)
+      with _OpenForReplace(args.audit_file) as audit_file:
+        return Hash(hash_cmd=args.hash_cmd or _DEFAULT_HASH_CMD,
+                    hash_algo=args.hash_algo,
+                    directories=directories,
+                    method=args.method,
+                    audit_file=audit_file,
+                    ignorefiles=list(args.ignorefile),
+                    ignorelines=list(args.ignoreline),
+                    max_workers=args.max_workers,
+                    large_file_threshold=args.large_file_threshold,
+                    tmp_backup_dir=args.tmp_backup_dir,
+                    previous_audit=previous_audit,
+                    console=console)
 
     elif args.cmd == 'audit':
       return Audit(hash_cmd=args.hash_cmd,
-                   directory=args.directory,
+                   hash_algo=args.hash_algo,
+                   directories=_GetRootDirectories(args),
                    audit_file=args.audit_file,
                    max_workers=args.max_workers,
+                   large_file_threshold=args.large_file_threshold,
                    show_delta=args.show_delta,
                    console=console)
     elif args.cmd == 'test_list_paths':
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+#
+# The ChangeGuard project requires contributions made to this file be licensed
+# under the MIT license or a compatible open source license. See LICENSE.md for
+# the license text.
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Dict, List, Set
+
+from .cli import _ReadDirectoryManifest
+
+# Modules that should only be imported on the code paths that need them, see
+# changeguard/changeguard.py.
+_HEAVY_MODULES = ('rich', 'rich_argparse', 'yaml', 'pathspec',
+                  'typing_extensions', 'importlib.metadata')
+
+_PROJ_PATH = Path(__file__).resolve().parent.parent
+
+
+def _Env() -> Dict[str, str]:
+  """The environment to run changeguard from this checkout."""
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join([str(_PROJ_PATH)] +
+                                      [p for p in [env.get('PYTHONPATH')] if p])
+  return env
+
+
+def _RunCli(*, args: List[str], cwd: Path) -> subprocess.CompletedProcess:
+  env = _Env()
+  return subprocess.run([sys.executable, '-m', 'changeguard.cli'] + args,
+                        cwd=str(cwd),
+                        env=env,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+
+
+def _RunWithImportTime(*, args: List[str], cwd: Path) -> Dict[str, int]:
+  """Runs python with `-X importtime`.
+
+  Returns:
+      Dict[str, int]: The cumulative import time in microseconds of each
+        imported module.
+  """
+  env = _Env()
+  result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                          cwd=str(cwd),
+                          env=env,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          check=True)
+  import_times: Dict[str, int] = {}
+  for line in result.stderr.decode('utf-8').splitlines():
+    # import time: self [us] | cumulative | imported package
+    if not line.startswith('import time:'):
+      continue
+    parts = line[len('import time:'):].split('|')
+    if len(parts) != 3 or not parts[1].strip().isdigit():
+      continue
+    import_times[parts[2].strip()] = int(parts[1])
+  return import_times
+
+
+class TestStartup(unittest.TestCase):
+  interpreter_modules: Set[str]
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.directory = Path(self.test_dir) / 'directory'
+    self.directory.mkdir()
+    (self.directory / 'file').write_text('contents')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  @classmethod
+  def setUpClass(cls):
+    # Modules that the interpreter imports on its own (e.g via site-packages
+    # .pth files) are not changeguard's doing.
+    cls.interpreter_modules = set(
+        _RunWithImportTime(args=['-c', 'pass'], cwd=Path.cwd()))
+
+  def assertNoHeavyImports(self, import_times: Dict[str, int]):
+    heavy = sorted(
+        module for module in import_times
+        if module not in self.interpreter_modules and (
+            module.split('.')[0] in _HEAVY_MODULES or module in _HEAVY_MODULES))
+    self.assertEqual(
+        heavy, [], 'changeguard.cli imported in'
+        f' {import_times.get("changeguard.cli", 0) / 1000:.1f}ms')
+
+  def test_import_cli(self):
+    import_times = _RunWithImportTime(args=['-c', 'import changeguard.cli'],
+                                      cwd=Path(self.test_dir))
+    self.assertIn('changeguard.cli', import_times)
+    self.assertNoHeavyImports(import_times)
+
+  def test_hash_and_audit(self):
+    audit_file = Path(self.test_dir) / 'audit.json'
+    common_args = [
+        '--directory',
+        str(self.directory), '--hash-algo', 'sha256', '--audit-file',
+        str(audit_file)
+    ]
+    self.assertNoHeavyImports(
+        _RunWithImportTime(args=[
+            '-m', 'changeguard.cli', 'hash', '--method', 'initial_iterdir'
+        ] + common_args,
+                           cwd=Path(self.test_dir)))
+    self.assertNoHeavyImports(
+        _RunWithImportTime(args=['-m', 'changeguard.cli', 'audit'] +
+                           common_args,
+                           cwd=Path(self.test_dir)))
+
+
+class TestHashAuditFile(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = Path(tempfile.mkdtemp())
+    self.directory = self.test_dir / 'directory'
+    self.directory.mkdir()
+    (self.directory / 'file').write_text('contents')
+    self.audit_file = self.test_dir / 'audit.json'
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def _Hash(self, *, hash_cmd: str,
+            extra_args: List[str]) -> subprocess.CompletedProcess:
+    return _RunCli(args=[
+        'hash', '--method', 'initial_iterdir', '--directory',
+        str(self.directory), '--hash-cmd', hash_cmd, '--audit-file',
+        str(self.audit_file)
+    ] + extra_args,
+                   cwd=self.test_dir)
+
+  def test_failed_update_keeps_previous_audit_file(self):
+    self.assertEqual(
+        self._Hash(hash_cmd='sha256sum', extra_args=[]).returncode, 0)
+    previous_contents = self.audit_file.read_text()
+
+    (self.directory / 'file').write_text('changed')
+    result = self._Hash(hash_cmd="sh -c 'exit 3'",
+                        extra_args=['--update', '--from',
+                                    str(self.audit_file)])
+    self.assertEqual(result.returncode, 1)
+    self.assertEqual(self.audit_file.read_text(), previous_contents)
+    self.assertEqual(sorted(p.name for p in self.test_dir.iterdir()),
+                     ['audit.json', 'directory'])
+
+  def test_audit_file_symlink_kept(self):
+    target = self.test_dir / 'target.json'
+    target.write_text('')
+    self.audit_file.symlink_to(target)
+    self.assertEqual(
+        self._Hash(hash_cmd='sha256sum', extra_args=[]).returncode, 0)
+    self.assertTrue(self.audit_file.is_symlink())
+    self.assertIn('"roots"', target.read_text())
+
+  def test_audit_file_not_regular(self):
+    self.audit_file = Path(os.devnull)
+    result = self._Hash(hash_cmd='sha256sum', extra_args=[])
+    self.assertEqual(result.returncode, 0, result.stderr)
+    self.assertEqual(sorted(p.name for p in self.test_dir.iterdir()),
+                     ['directory'])
+
+  def test_missing_audit_file_dir(self):
+    self.audit_file = self.test_dir / 'missing' / 'audit.json'
+    result = self._Hash(hash_cmd='sha256sum', extra_args=[])
+    self.assertEqual(result.returncode, 2)
+    self.assertIn(b'does not exist or is not writable', result.stderr)
+
+
+class TestReadDirectoryManifest(unittest.TestCase):
+
+  def test_read(self):
+    manifest = io.StringIO('a\n'
+                           '# comment\n'
+                           '\n'
+                           '  b/c  \n'
+                           '/abs/d\n')
+    manifest.name = 'path/to/manifest.txt'
+    self.assertEqual(_ReadDirectoryManifest(manifest), [
+        Path('path/to/a'),
+        Path('path/to/b/c'),
+        Path('/abs/d'),
+    ])
+
+
+if __name__ == '__main__':
+  unittest.main()